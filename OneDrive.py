@@ -21,15 +21,23 @@ from __future__ import annotations
 
 import re
 import json
+import functools
+import concurrent.futures
 import os
+import sqlite3
 import webbrowser
 import threading
 import time
 from datetime import datetime
-from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+from urllib.parse import SplitResult, unquote, urljoin, urlsplit, urlunsplit
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, render_template, request, jsonify
+from flask.json.provider import JSONProvider
+from jinja2 import FileSystemBytecodeCache
 
 
 USER_AGENT = (
@@ -38,82 +46,181 @@ USER_AGENT = (
     "Chrome/126.0 Safari/537.36"
 )
 
+# 预编译的正则表达式，避免每次请求都查找 re 模块内部缓存
+_SHAREPOINT_SHARE_RE = re.compile(r'/:u:/g/personal/([^/]+)/([^/?#]+)')
+_HTTP_SCHEME_RE = re.compile(r'^https?://', re.IGNORECASE)
+# SharePoint（企业版或世纪互联）主机名
+_SHAREPOINT_HOST_RE = re.compile(r'sharepoint\.(?:com|cn)|my\.sharepoint')
+
+# 个人版直链使用的 dlink.host 服务
+_DLINK_HOST = "dlink.host"
+
+# 支持的域名后缀
+_HOST_SUFFIXES = frozenset(
+    (
+        "1drv.ms",
+        "onedrive.live.com",
+        "sharepoint.com",
+        "my.sharepoint.com",
+        "sharepoint.cn",
+        "my.sharepoint.cn",
+    )
+)
+_HOST_SUFFIX_RE = re.compile(
+    r'(?:^|\.)(?:'
+    + "|".join(re.escape(suffix) for suffix in sorted(_HOST_SUFFIXES, key=len, reverse=True))
+    + r')$'
+)
+
+# 全局共享的 HTTP 会话：复用连接池与 TLS 连接，避免每次展开短链都重新握手
+_SESSION = requests.Session()
+_SESSION.headers["User-Agent"] = USER_AGENT
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=64,
+        # 只对 502/503/504 这类快速返回的错误重试；超时不重试，且忽略 Retry-After，
+        # 否则单次请求内部的等待会超出 normalize_url 的总时限
+        max_retries=Retry(
+            total=2,
+            connect=0,
+            read=0,
+            backoff_factor=0.2,
+            status_forcelist=(502, 503, 504),
+            respect_retry_after_header=False,
+        ),
+    ),
+)
+# 正常的短链跳转不超过 3 跳，限制上限以避免过长或恶意的重定向链
+_MAX_REDIRECTS = 5
+_SESSION.max_redirects = _MAX_REDIRECTS
+
+# 展开短链的共享线程池：限制并发的网络请求数并复用线程，与 _SESSION 共享连接池。
+# 只有需要联网的短链展开会提交到这里，SharePoint 等纯字符串转换不会排队
+_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix="onedrive")
+
 
 class OneDriveLinkError(Exception):
     pass
 
 
-def normalize_url(original_url: str, timeout: float) -> str:
-    """展开 1drv.ms 等短链，返回实际的分享页 URL。"""
+def _remaining(deadline: float) -> float:
+    """返回距 deadline 的剩余秒数，已超时则抛出 OneDriveLinkError。"""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise OneDriveLinkError("展开链接超时，请稍后重试")
+    return remaining
+
+
+def _normalize_url_uncached(original_url: str, timeout: float) -> str:
+    """
+    展开 1drv.ms 等短链，返回实际的分享页 URL。
+
+    手动跟随重定向：最多跳转 _MAX_REDIRECTS 次并检测循环，
+    一旦跳转到非短链的受支持域名即提前返回，无需走完整条重定向链。
+    timeout 为整个展开过程的总时限，而非单次请求的时限。
+    """
+    deadline = time.monotonic() + timeout
     try:
-        resp = requests.head(
-            original_url,
-            allow_redirects=True,
-            timeout=timeout,
-            headers={"User-Agent": USER_AGENT},
-        )
-        if resp.status_code in (405, 403) or resp.is_redirect:
-            resp = requests.get(
-                original_url,
-                allow_redirects=True,
-                timeout=timeout,
-                headers={"User-Agent": USER_AGENT},
-                stream=True,
-            )
-        return resp.url
+        url = original_url
+        seen = {url}
+        # 第 i 次循环请求的是经过 i 次跳转后的 URL，因此共需 _MAX_REDIRECTS + 1 次请求
+        for hop in range(_MAX_REDIRECTS + 1):
+            # 用 with 确保连接在任何情况下都及时归还连接池
+            with _SESSION.head(url, allow_redirects=False, timeout=_remaining(deadline)) as resp:
+                status_code = resp.status_code
+                location = resp.headers.get("Location") if resp.is_redirect else None
+                final_url = resp.url
+            # 服务器不支持 HEAD 时才退回 GET，只取最终 URL，不下载响应体
+            if status_code in (405, 403):
+                with _SESSION.get(
+                    url,
+                    allow_redirects=True,
+                    timeout=_remaining(deadline),
+                    stream=True,
+                ) as resp:
+                    return resp.url
+            if location is None:
+                return final_url
+            if hop == _MAX_REDIRECTS:
+                break
+
+            url = urljoin(url, location)
+            if url in seen:
+                raise OneDriveLinkError(f"链接重定向出现循环: {url}")
+            seen.add(url)
+
+            # 已跳转到真正的分享页，后续重定向对解析没有帮助
+            if _url_host(url) != "1drv.ms" and is_onedrive_supported_host(url):
+                return url
+
+        raise OneDriveLinkError(f"链接重定向次数过多（超过 {_MAX_REDIRECTS} 次）")
     except requests.RequestException as exc:
         raise OneDriveLinkError(f"无法展开链接: {exc}") from exc
 
 
+# 短链一经生成不会改变，缓存展开结果以免重复提交时再走网络请求。
+# 调用方始终传入相同的 timeout，因此它不会分裂缓存；异常不会被缓存。
+normalize_url = functools.lru_cache(maxsize=1024)(_normalize_url_uncached)
+
+
+def _url_host(url: str) -> str:
+    """直接切分字符串取出小写主机名（去掉用户信息和端口），无需完整的 urlparse。"""
+    netloc = url.partition("://")[2]
+    for sep in ("/", "?", "#"):
+        netloc = netloc.partition(sep)[0]
+    return netloc.rpartition("@")[2].partition(":")[0].lower()
+
+
+def _is_supported_host(host: str) -> bool:
+    """host 须为已转小写的主机名。"""
+    return bool(host) and _HOST_SUFFIX_RE.search(host) is not None
+
+
+@functools.lru_cache(maxsize=2048)
 def is_onedrive_supported_host(url: str) -> bool:
-    host = urlparse(url).hostname or ""
-    host = host.lower()
-    if not host:
-        return False
-    return any(
-        host.endswith(suffix)
-        for suffix in (
-            "1drv.ms",
-            "onedrive.live.com",
-            "sharepoint.com",
-            "my.sharepoint.com",
-            "sharepoint.cn",
-            "my.sharepoint.cn",
-        )
-    )
+    return _is_supported_host(_url_host(url))
 
 
+@functools.lru_cache(maxsize=2048)
 def is_folder_link(url: str) -> bool:
     """检测是否为文件夹分享链接。"""
-    parsed = urlparse(url)
-    path_lower = (parsed.path or "").lower()
-    
-    # SharePoint 路径包含 ":f:" 基本可判定为文件夹
-    if ":f:" in path_lower:
-        return True
+    url_lower = url.lower()
     
-    # 检查是否为文档库根目录等文件夹类型
-    if ":b:" in path_lower or "forms/allitems.aspx" in path_lower:
-        return True
-    
-    return False
+    # SharePoint 路径包含 ":f:" 基本可判定为文件夹；
+    # ":b:" 与 forms/allitems.aspx 为文档库根目录等文件夹类型
+    return ":f:" in url_lower or ":b:" in url_lower or "forms/allitems.aspx" in url_lower
 
 
-def convert_sharepoint_to_direct_link(url: str) -> str:
+@functools.lru_cache(maxsize=2048)
+def convert_sharepoint_to_direct_link(url: str, parsed: SplitResult | None = None) -> str:
     """
     将 SharePoint 分享链接转换为直接下载链接
     
     按照用户提供的转换规则:
     输入: https://xxxx-my.sharepoint.cn/:u:/g/personal/xxxx_xxxx_partner_onmschina_cn/XY16c5xGfSxDn91zeEE3A2UBVpoPOzfNzUEDW6dQ
     输出: https://xxxx-my.sharepoint.cn/personal/xxxx_xxxx_partner_onmschina_cn/_layouts/52/download.aspx?share=XY16c5xGfSxDn91zeEE3A2UBVpoPOzfNzUEDW6dQ
+    
+    parsed 为调用方已解析好的 url，传入可避免重复解析。
+    结果按参数缓存；转换失败抛出的异常不会被缓存。
     """
-    parsed = urlparse(url)
+    if parsed is None:
+        parsed = urlsplit(url)
     domain = parsed.netloc
     path = parsed.path
     
     # 只处理标准的 SharePoint 分享链接格式
     # /:u:/g/personal/用户名/分享token
-    match = re.search(r'/:u:/g/personal/([^/]+)/([^/?#]+)', path)
+    # 结构固定，先用字符串切分，失败时再用正则兜底
+    _, sep, rest = path.partition('/:u:/g/personal/')
+    if sep:
+        personal_user, slash, share_token = rest.partition('/')
+        share_token = share_token.split('/', 1)[0]
+        if personal_user and slash and share_token:
+            return f"https://{domain}/personal/{personal_user}/_layouts/52/download.aspx?share={share_token}"
+    
+    match = _SHAREPOINT_SHARE_RE.search(path)
     if match:
         personal_user = match.group(1)
         share_token = match.group(2)
@@ -129,6 +236,16 @@ def convert_sharepoint_to_direct_link(url: str) -> str:
     )
 
 
+def _first_qs_value(query: str, key: str) -> str | None:
+    """单次扫描查询字符串，返回 key 的第一个值（已解码），不存在时返回 None。"""
+    prefix = key + '='
+    for pair in query.split('&'):
+        if pair.startswith(prefix):
+            return unquote(pair[len(prefix):])
+    return None
+
+
+@functools.lru_cache(maxsize=2048)
 def convert_personal_onedrive_to_direct_link(url: str) -> str:
     """
     将个人版 OneDrive 链接转换为真正的无登录直链
@@ -136,19 +253,18 @@ def convert_personal_onedrive_to_direct_link(url: str) -> str:
     使用 dlink.host 服务，通过提取 redeem 参数生成直链
     这是目前最有效的个人版OneDrive直链生成方法
     """
-    parsed = urlparse(url)
-    query_params = dict(parse_qsl(parsed.query))
+    query = urlsplit(url).query
     
     # 方法1: 提取 redeem 参数，使用 dlink.host 服务
-    if 'redeem' in query_params:
-        redeem_value = query_params['redeem']
+    redeem_value = _first_qs_value(query, 'redeem')
+    if redeem_value:
         dlink_url = f"https://dlink.host/1drv/{redeem_value}"
         return dlink_url
     
     # 方法2: 如果有 resid 和 authkey，尝试传统格式
-    if 'resid' in query_params and 'authkey' in query_params:
-        file_id = query_params['resid']
-        authkey = query_params['authkey']
+    file_id = _first_qs_value(query, 'resid')
+    authkey = _first_qs_value(query, 'authkey') if file_id else None
+    if file_id and authkey:
         return f"https://onedrive.live.com/download?resid={file_id}&authkey={authkey}"
     
     # 回退到传统方法
@@ -157,44 +273,55 @@ def convert_personal_onedrive_to_direct_link(url: str) -> str:
 
 def ensure_download_param_fallback(url: str) -> str:
     """传统的 download=1 方法（备用）"""
-    parsed = urlparse(url)
-    query_pairs = dict(parse_qsl(parsed.query))
+    parsed = urlsplit(url)
     
-    if "download" not in {k.lower() for k in query_pairs.keys()}:
-        query_pairs["download"] = "1"
+    # 已有 download 参数（不区分大小写）时原样返回
+    if '&download=' in '&' + parsed.query.lower():
+        return url
     
-    new_query = urlencode(query_pairs, doseq=True)
-    new_url = urlunparse(
-        (
-            parsed.scheme,
-            parsed.netloc,
-            parsed.path,
-            parsed.params,
-            new_query,
-            parsed.fragment,
-        )
-    )
-    return new_url
+    new_query = parsed.query + '&download=1' if parsed.query else 'download=1'
+    return urlunsplit((parsed.scheme, parsed.netloc, parsed.path, new_query, parsed.fragment))
+
+
+def _is_direct_link(parsed: SplitResult) -> bool:
+    """按路径和查询参数判断是否为本工具在受支持域名上生成的直链。"""
+    path = parsed.path
+    if path.endswith("/_layouts/52/download.aspx"):
+        return "share=" in parsed.query
+    return path == "/download" and "resid=" in parsed.query
 
 
 def parse_onedrive_direct_link(input_url: str, timeout: float = 15.0) -> str:
-    if not re.match(r"^https?://", input_url, flags=re.IGNORECASE):
+    if not _HTTP_SCHEME_RE.match(input_url):
         raise OneDriveLinkError("请输入以 http:// 或 https:// 开头的分享链接")
 
+    # 只解析一次，后续检查与转换共用
+    parsed = urlsplit(input_url)
+    host = parsed.hostname or ""
+
+    # 已经是直链（如从历史记录再次提交）时原样返回，无需解析或网络请求
+    if host == _DLINK_HOST and parsed.path.startswith("/1drv/"):
+        return input_url
+
     # 先检查原始链接是否为标准格式
-    if not is_onedrive_supported_host(input_url):
+    if not _is_supported_host(host):
         raise OneDriveLinkError("不支持的链接域名：仅支持 OneDrive/SharePoint/世纪互联分享链接")
 
-    parsed = urlparse(input_url)
-    host = parsed.netloc.lower()
+    if _is_direct_link(parsed):
+        return input_url
     
     # 判断是否为 SharePoint（企业版或世纪互联）
-    if any(domain in host for domain in ['sharepoint.com', 'sharepoint.cn', 'my.sharepoint']):
+    if _SHAREPOINT_HOST_RE.search(host):
         # 对于 SharePoint，直接解析原始链接，不要跟随重定向
-        return convert_sharepoint_to_direct_link(input_url)
+        return convert_sharepoint_to_direct_link(input_url, parsed)
     else:
         # 对于个人版 OneDrive，先展开短链再处理
-        expanded = normalize_url(input_url, timeout=timeout)
+        # 在共享线程池中执行，额外留出重试与退避的余量
+        future = _EXECUTOR.submit(normalize_url, input_url, timeout)
+        try:
+            expanded = future.result(timeout=timeout + 5)
+        except concurrent.futures.TimeoutError as exc:
+            raise OneDriveLinkError("展开链接超时，请稍后重试") from exc
         
         # 对于个人版，使用传统方法并添加说明
         direct_link = convert_personal_onedrive_to_direct_link(expanded)
@@ -213,31 +340,237 @@ def parse_onedrive_direct_link(input_url: str, timeout: float = 15.0) -> str:
 
 # ============= Flask 网页应用 =============
 
+class OrjsonJSONProvider(JSONProvider):
+    """使用 orjson 编解码 JSON，jsonify 直接输出 UTF-8 字节，省去 str 到 bytes 的转换"""
+
+    def _dumps_bytes(self, obj, **kwargs):
+        # 将 json.dumps 风格的参数映射为 orjson 选项，无法对应的参数直接报错
+        option = 0
+        if kwargs.pop('sort_keys', False):
+            option |= orjson.OPT_SORT_KEYS
+        indent = kwargs.pop('indent', None)
+        if indent is not None:
+            if indent != 2:
+                raise TypeError("orjson 仅支持 indent=2")
+            option |= orjson.OPT_INDENT_2
+        if kwargs.pop('ensure_ascii', False):
+            raise TypeError("orjson 不支持 ensure_ascii=True，输出始终为 UTF-8")
+        default = kwargs.pop('default', None)
+        if kwargs:
+            raise TypeError(f"OrjsonJSONProvider 不支持的参数: {', '.join(kwargs)}")
+        return orjson.dumps(obj, default=default, option=option)
+
+    def dumps(self, obj, **kwargs):
+        return self._dumps_bytes(obj, **kwargs).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            raise TypeError(f"OrjsonJSONProvider 不支持的参数: {', '.join(kwargs)}")
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # 与 jsonify 的约定一致：单个位置参数原样序列化，多个视为列表，否则使用关键字参数
+        if args and kwargs:
+            raise TypeError("jsonify() 不能同时传入位置参数和关键字参数")
+        obj = args[0] if len(args) == 1 else args or kwargs
+        return self._app.response_class(self._dumps_bytes(obj), mimetype="application/json")
+
+
 app = Flask(__name__)
+app.json = OrjsonJSONProvider(app)
 
-# 历史记录文件路径
-HISTORY_FILE = "onedrive_history.json"
+# 设置 ONEDRIVE_DEV=1 时使用 Flask 调试服务器（自动重载），否则使用 Waitress
+DEV_MODE = os.environ.get('ONEDRIVE_DEV') == '1'
 
-def load_history():
-    """加载历史记录"""
-    if os.path.exists(HISTORY_FILE):
+# 模板编译结果缓存到磁盘，重启后无需重新编译；目录不可写时不使用缓存
+JINJA_CACHE_DIR = os.path.join(app.root_path, '.jinja_cache')
+try:
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+except OSError as e:
+    print(f"无法创建模板缓存目录，已禁用模板缓存: {e}")
+else:
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory=JINJA_CACHE_DIR)
+if not DEV_MODE:
+    # 生产模式下模板不会变化，无需检查源文件是否修改
+    app.config['TEMPLATES_AUTO_RELOAD'] = False
+    app.jinja_env.auto_reload = False
+
+# 历史记录数据库路径
+HISTORY_FILE = "onedrive_history.db"
+# 旧版 JSON 历史记录文件，数据库为空时自动导入一次
+LEGACY_HISTORY_FILE = "onedrive_history.json"
+
+# 历史记录最大条数
+HISTORY_LIMIT = 100
+
+_HISTORY_COLUMNS = ('id', 'url', 'remark', 'timestamp', 'original_url')
+
+# 多个请求线程共享同一连接，语句执行需持有 _HISTORY_LOCK
+_HISTORY_LOCK = threading.Lock()
+
+
+def _open_history_db():
+    """打开历史记录数据库，并确保表结构存在"""
+    conn = sqlite3.connect(HISTORY_FILE, check_same_thread=False, isolation_level=None)
+    try:
+        # 文件损坏时 quick_check 会抛出 DatabaseError 或返回非 ok 的结果
+        result = conn.execute("PRAGMA quick_check").fetchone()
+        if result is None or result[0] != "ok":
+            raise sqlite3.DatabaseError(f"quick_check 失败: {result}")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # seq 由服务端生成，决定记录先后；id 为客户端提供的任意值，原样保存
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS history("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, id, url TEXT NOT NULL UNIQUE, "
+            "remark TEXT, timestamp TEXT, original_url TEXT)"
+        )
+    except sqlite3.DatabaseError:
+        # 先关闭连接，否则 Windows 上无法移动文件
+        conn.close()
+        raise
+    return conn
+
+
+def _archive_corrupt_file(path):
+    """将损坏的文件改名为 *.corrupt 保留，避免之后再次读取"""
+    try:
+        os.replace(path, path + '.corrupt')
+        print(f"已将损坏的历史记录文件移动到 {path}.corrupt")
+    except OSError as e:
+        print(f"移动损坏的历史记录文件失败: {e}")
+
+
+def _archive_corrupt_db():
+    """归档损坏的数据库及其 WAL/SHM 文件，避免新库误用旧日志"""
+    _archive_corrupt_file(HISTORY_FILE)
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(HISTORY_FILE + suffix):
+            _archive_corrupt_file(HISTORY_FILE + suffix)
+
+
+def _read_legacy_history_file():
+    """读取旧版 JSON 历史记录文件"""
+    if not os.path.exists(LEGACY_HISTORY_FILE):
+        return []
+    try:
+        with open(LEGACY_HISTORY_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        print(f"历史记录文件已损坏: {e}")
+        _archive_corrupt_file(LEGACY_HISTORY_FILE)
+        return []
+    except OSError as e:
+        print(f"读取历史记录文件失败: {e}")
+        return []
+    if not isinstance(data, list):
+        print("历史记录文件格式不正确：顶层应为列表")
+        _archive_corrupt_file(LEGACY_HISTORY_FILE)
+        return []
+    return data
+
+
+# SQLite INTEGER 可表示的范围
+_SQLITE_INT_MIN = -2 ** 63
+_SQLITE_INT_MAX = 2 ** 63 - 1
+
+# 相同 url 原位更新（保留 seq，不改变顺序），否则追加到最新
+_UPSERT_HISTORY_SQL = (
+    "INSERT INTO history (id, url, remark, timestamp, original_url) VALUES (?, ?, ?, ?, ?) "
+    "ON CONFLICT(url) DO UPDATE SET id = excluded.id, remark = excluded.remark, "
+    "timestamp = excluded.timestamp, original_url = excluded.original_url"
+)
+
+
+def _history_row(history_item):
+    """将历史记录项转换为数据库行，格式不正确时抛出 KeyError/TypeError"""
+    row = (
+        history_item.get('id'),
+        history_item['url'],
+        history_item.get('remark', ''),
+        history_item.get('timestamp', ''),
+        history_item.get('original_url', ''),
+    )
+    if not isinstance(row[1], str):
+        raise TypeError("url 必须是字符串")
+    if not all(value is None or isinstance(value, (str, int, float)) for value in row):
+        raise TypeError("历史记录字段必须是字符串或数字")
+    if any(isinstance(value, int) and not _SQLITE_INT_MIN <= value <= _SQLITE_INT_MAX for value in row):
+        raise ValueError("历史记录中的整数超出 SQLite 可表示的范围")
+    return row
+
+
+def _import_legacy_history():
+    """数据库为空时导入旧版 JSON 历史记录，全部成功或全部回滚"""
+    with _HISTORY_LOCK:
+        _HISTORY_DB.execute("BEGIN")
+        try:
+            _import_legacy_rows()
+        except BaseException:
+            _HISTORY_DB.execute("ROLLBACK")
+            raise
+        _HISTORY_DB.execute("COMMIT")
+
+
+def _import_legacy_rows():
+    if _HISTORY_DB.execute("SELECT 1 FROM history LIMIT 1").fetchone():
+        return
+    # 旧文件中最新的记录在前，倒序插入以保留去重时的先后关系
+    rows = []
+    skipped = 0
+    for item in reversed(_read_legacy_history_file()):
         try:
-            with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return []
-    return []
-
-def save_history_to_file(history_data):
-    """保存历史记录到文件"""
+            rows.append(_history_row(item))
+        except (AttributeError, KeyError, TypeError, ValueError):
+            skipped += 1
+    if skipped:
+        print(f"已跳过 {skipped} 条格式不正确的历史记录")
+    if rows:
+        _HISTORY_DB.executemany(_UPSERT_HISTORY_SQL, rows)
+
+
+def load_history():
+    """加载历史记录（最新的在前）"""
+    with _HISTORY_LOCK:
+        rows = _HISTORY_DB.execute(
+            "SELECT id, url, remark, timestamp, original_url FROM history ORDER BY seq DESC LIMIT ?",
+            (HISTORY_LIMIT,),
+        ).fetchall()
+    return [dict(zip(_HISTORY_COLUMNS, row)) for row in rows]
+
+
+def save_history_to_file(history_item):
+    """保存一条历史记录，相同 url 的旧记录会被原位更新"""
     try:
-        with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(history_data, f, ensure_ascii=False, indent=2)
+        with _HISTORY_LOCK:
+            _HISTORY_DB.execute(_UPSERT_HISTORY_SQL, _history_row(history_item))
+            # 限制记录数量，淘汰最旧的记录
+            _HISTORY_DB.execute(
+                "DELETE FROM history WHERE seq NOT IN (SELECT seq FROM history ORDER BY seq DESC LIMIT ?)",
+                (HISTORY_LIMIT,),
+            )
         return True
-    except Exception as e:
+    except (sqlite3.Error, OverflowError) as e:
         print(f"保存历史记录失败: {e}")
         return False
 
+
+try:
+    _HISTORY_DB = _open_history_db()
+except sqlite3.OperationalError:
+    # 数据库被锁定、无权限等属于环境问题，文件本身完好，不能当作损坏归档
+    raise
+except sqlite3.DatabaseError as e:
+    # 数据库文件损坏时归档后重建，而不是让程序无法启动
+    print(f"历史记录数据库已损坏: {e}")
+    _archive_corrupt_db()
+    _HISTORY_DB = _open_history_db()
+try:
+    _import_legacy_history()
+except (sqlite3.Error, OverflowError) as e:
+    # 导入失败不影响启动，只是没有旧记录
+    print(f"导入旧版历史记录失败: {e}")
+
 @app.get("/")
 def index_get():
     return render_template("index.html", result=None, error=None, form={})
@@ -278,9 +611,6 @@ def save_history():
         if not data or 'url' not in data:
             return jsonify({'success': False, 'error': '缺少必要参数'})
         
-        # 加载现有历史记录
-        history = load_history()
-        
         # 创建新的历史记录项
         history_item = {
             'id': data.get('id', int(datetime.now().timestamp() * 1000)),
@@ -290,19 +620,8 @@ def save_history():
             'original_url': data.get('original_url', ''),  # 可选：保存原始链接
         }
         
-        # 避免重复
-        existing_index = next((i for i, item in enumerate(history) if item['url'] == history_item['url']), -1)
-        if existing_index != -1:
-            history[existing_index] = history_item  # 更新现有记录
-        else:
-            history.insert(0, history_item)  # 添加到开头
-        
-        # 限制记录数量
-        if len(history) > 100:
-            history = history[:100]
-        
-        # 保存到文件
-        if save_history_to_file(history):
+        # 保存（自动去重并限制记录数量）
+        if save_history_to_file(history_item):
             return jsonify({'success': True, 'message': '历史记录已保存'})
         else:
             return jsonify({'success': False, 'error': '保存失败'})
@@ -319,6 +638,12 @@ def get_history():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.post("/clear_cache")
+def clear_cache():
+    """清空短链展开缓存的API端点"""
+    normalize_url.cache_clear()
+    return jsonify({'success': True, 'message': '缓存已清空'})
+
 
 def open_browser():
     """延迟打开浏览器"""
@@ -335,5 +660,10 @@ if __name__ == "__main__":
         # 在后台线程中打开浏览器
         threading.Thread(target=open_browser, daemon=True).start()
     
-    # 启动Flask应用
-    app.run(host="127.0.0.1", port=5000, debug=True)
\ No newline at end of file
+    if DEV_MODE:
+        # 开发模式：Flask 调试服务器
+        app.run(host="127.0.0.1", port=5000, debug=True)
+    else:
+        # 生产模式：Waitress 多线程 WSGI 服务器
+        from waitress import serve
+        serve(app, host="127.0.0.1", port=5000, threads=16)
\ No newline at end of file